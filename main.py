@@ -1,73 +1,283 @@
-import requests
+import asyncio
+import aiohttp
 import json
-from bs4 import BeautifulSoup
+import math
+import multiprocessing
+import os
+import random
+import re
+import signal
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+from urllib.parse import unquote, urlparse
+from lxml import etree, html
+try:
+  from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+  LexborHTMLParser = None #fall back to lxml
+try:
+  import orjson
+except ImportError:
+  orjson = None #fall back to json
 
-#iterate over the array to create a permutation set
+#result anchors on either google results page, one union so the tree is walked once
+resultSelector = 'a[href^="/url?q="], a[href^="http"], .yuRUbf a[href], h3 a[href]'
+#compiled once instead of on every call, plain strings so results pickle back from the pool
+linkXPath = etree.XPath('//a[starts-with(@href, "/url?q=") or starts-with(@href, "http")'
+  ' or ancestor::*[contains(concat(" ", normalize-space(@class), " "), " yuRUbf ")] or ancestor::h3]/@href', smart_strings=False)
+keywordsXPath = etree.XPath('//meta[@name="keywords"]/@content', smart_strings=False)
+#meta keywords live in the head, nothing after it is needed
+headEnd = re.compile(rb'</head\s*>', re.IGNORECASE)
+#google's redirect links, read straight from the raw search page
+googleURLPattern = re.compile(rb'href="/url\?q=([^"&]+)')
+#the same target taken from a parsed href, dropping &sa= and any other parameter
+redirectPattern = re.compile(r'^/url\?q=([^&]+)')
+#scheme and host of a url worth fetching, skipping any user:password@
+validURLPattern = re.compile(r'^https?://(?:[^/?#@]*@)?([^/?#:@]+)', re.IGNORECASE)
+bannedHosts = frozenset(('google.com', 'googleusercontent.com')) #google's own pages aren't results
+
+#only http(s) links to sites other than google
+def isValidURL(url):
+  match = validURLPattern.match(url)
+  if not match:
+    return False
+  host = match.group(1).lower()
+  return not any(host == banned or host.endswith("." + banned) for banned in bannedHosts)
+
+#libxml2 reads the raw bytes and finds the charset itself
+#None for an empty or unreadable page
+def parseHTML(content):
+  try:
+    return html.document_fromstring(content)
+  except etree.LxmlError:
+    return None
+
+#href of every result link on the page, redirects or direct, found in one pass
+#deduplicated, lexbor returns a node once for each branch of the union it matches
+def getHrefs(content):
+  if LexborHTMLParser is not None:
+    tree = LexborHTMLParser(content)
+    return list(dict.fromkeys(node.attributes.get('href') or "" for node in tree.css(resultSelector)))
+  tree = parseHTML(content)
+  return list(dict.fromkeys(linkXPath(tree))) if tree is not None else []
+
+#content of the keywords meta tags
+def getMetaKeywords(content):
+  if LexborHTMLParser is not None:
+    tree = LexborHTMLParser(content)
+    return [node.attributes.get('content') for node in tree.css('meta[name="keywords"]')]
+  tree = parseHTML(content)
+  return keywordsXPath(tree) if tree is not None else []
+
+hostLocks = defaultdict(asyncio.Lock) #one queue per site
+hostLastHit = {} #when each site was last asked for a page
+
+#send a request once hostDelay has passed since the last one to this site, other sites aren't held up
+#the site's lock is held until the request is sent, so requests queued behind it can't leave together
+async def startRequest(session, url, sem, host, headers):
+  async with hostLocks[host]:
+    wait = hostLastHit.get(host, 0) + hostDelay - time.monotonic()
+    if wait > 0:
+      await asyncio.sleep(wait) #before taking a slot, so waiting doesn't block other sites
+    async with sem:
+      page = await session.get(url, headers=headers)
+    hostLastHit[host] = time.monotonic()
+  return page
+
+#fetch a page and return its body, None if it keeps failing or isn't html
+#the semaphore caps requests waiting on a response, the connector caps open connections
+#headOnly stops reading once the <head> is complete
+async def fetch(session, url, sem, headOnly=False):
+  try:
+    host = urlparse(url).netloc
+  except ValueError:
+    return None #malformed url, nothing to fetch
+  headers = None #the session's user agent
+  for retries in range(maxRetries):
+    delay = 2**retries
+    try:
+      page = await startRequest(session, url, sem, host, headers)
+      async with page:
+        if page.status not in retryStatus:
+          page.raise_for_status()
+          contentType = page.headers.get('Content-Type', "").lower()
+          if contentType and 'html' not in contentType and 'xml' not in contentType:
+            return None #pdfs, images and downloads have no keywords
+          return await readBody(page, headOnly)
+        #a 429 usually says how long to wait
+        retryAfter = page.headers.get('Retry-After', "")
+        if retryAfter.isdigit():
+          if int(retryAfter) > maxRetryAfter:
+            return None #not worth waiting that long
+          delay = max(delay, int(retryAfter))
+        if page.status == 429:
+          #retry looking like someone else, the full results page this gets is handled by getHrefs
+          headers = {'User-Agent': random.choice(userAgents)}
+    except aiohttp.ClientResponseError:
+      return None #any other 4xx won't change on retry
+    except ValueError:
+      return None #a host that can't be encoded, retrying won't fix it
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+      pass
+    if retries < maxRetries - 1:
+      await asyncio.sleep(delay) #back off outside the semaphore
+  return None
+
+#read at most maxBytes of the body, stopping early at </head> if asked
+async def readBody(page, headOnly):
+  body = bytearray()
+  async for chunk in page.content.iter_chunked(65536):
+    body += chunk
+    if len(body) >= maxBytes:
+      break
+    if headOnly and headEnd.search(body, max(0, len(body)-len(chunk)-8)):
+      break
+  return bytes(body[:maxBytes])
+
+#search google for one keyword query and return it with the sites ranked for it
+async def searchQuery(session, sem, pool, keywords):
+  content = await fetch(session, baseurl+keywords, sem)
+  if content is None:
+    return keywords, []
+  outboundsLinks = [unquote(match.group(1).decode('utf-8', 'replace')) for match in googleURLPattern.finditer(content)]
+  if not outboundsLinks:
+    #markup we didn't expect, parse the page instead
+    hrefs = await asyncio.get_running_loop().run_in_executor(pool, getHrefs, content)
+    for href in hrefs:
+      match = redirectPattern.match(href)
+      if match:
+        outboundsLinks.append(unquote(match.group(1)))
+      else:
+        outboundsLinks.append(href) #a direct link, isValidURL decides if it's a result
+  #google can list a site twice on one page
+  return keywords, [link for link in dict.fromkeys(outboundsLinks) if isValidURL(link)]
+
+#fetch a ranked site and return it with its meta keywords
+async def scrapeKeywords(session, sem, pool, link):
+  content = await fetch(session, link, sem, headOnly=True)
+  print(link)
+  if content is None:
+    print("Link Broken")
+    return link, []
+  #get all keywords, parsing in the pool keeps the event loop free for fetches
+  return link, await asyncio.get_running_loop().run_in_executor(pool, getMetaKeywords, content)
+
+#pool workers leave ctrl-c to the main process, which cancels their work
+def ignoreInterrupt():
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+#append one record to the log, unbuffered so an interrupted run keeps it
+def writeLog(log, record):
+  if orjson is not None:
+    log.write(orjson.dumps(record) + b"\n")
+  else:
+    log.write(json.dumps(record, ensure_ascii = False).encode() + b"\n")
+
+#every combination of the keywords joined into a query, streamed one at a time
 #it does not include set with all the keywords
-def perKeywords(A,sub,char):
-  for k in A:
-    temp = A.copy()
-    temp.remove(k)
-    conc = ""
-    for i in range(len(temp)):
-      conc=conc+char+temp[i]
-    conc=conc[1:]
-    if len(conc)>=1:
-      if conc not in sub:
-        sub.append(conc)
-        perKeywords(temp,sub,char)
-    elif len(conc)>1:
-      sub.append(conc)
-      return sub
-
-searchKeywords = [] #keywords to search
+def keywordCombinations(keywords, char):
+  return (char.join(c) for r in range(1, len(keywords)) for c in combinations(keywords, r))
+
 querryChar = "+"
 basicKeywords = ["daa","system","simple","functional"]
-perKeywords(basicKeywords, searchKeywords, querryChar)
-usedKeywords =[] #output of keywords
 baseurl = "https://google.com/search?q="
-fetchURL = []
-for keywords in searchKeywords:
-  fetchURL.append(baseurl+keywords)
-allURLs=[] #URL to export
-# Fetch urls itertatively and find keywords
-for url in fetchURL:
-  page = requests.get(url)
-  soup = BeautifulSoup(page.content, 'html.parser')
-
-  outboundsLinks = []
-  links = soup.select('a')
-
-  for elem in links:
-    #print(elem.get('href')[0:7])
-    if elem.get('href')[0:7] == "/url?q=":
-      outboundsLinks.append(elem.get('href')[7:])
-
-  for links in range(len(outboundsLinks)):
-    outboundsLinks[links-1]=outboundsLinks[links-1][0:(outboundsLinks[links-1].find("&sa="))]
-  allURLs.append(outboundsLinks)
-  relatedMetaKeywords = []
-  for link in outboundsLinks:
-    try:
-      print(link)
-      page = requests.get(link)
-      soup = BeautifulSoup(page.content, 'html.parser')
-      #get all keywords
-      metaKeywords = soup.select('[name="keywords"]')
-      for elem in metaKeywords:
-        usedKeywords.append(elem.get('content'))
-      relatedMetaKeywords.append(metaKeywords)
-    except:
-      print("Link Broken")
-      pass
+exportFile = "LinksKeys-liteBiws.json"
+logFile = "LinksKeys-liteBiws.jsonl" #written as results arrive, consolidated into exportFile
+concurrency = 8 #requests in flight at once
+perHost = 2 #politeness limit for any single site
+hostDelay = 1.0 #seconds between requests to the same site
+maxRetries = 3
+maxRetryAfter = 30 #longest Retry-After we will wait, in seconds
+retryStatus = (429, 500, 502, 503, 504) #responses worth asking again
+keepAlive = 60 #seconds an idle connection stays in the pool
+maxBytes = 2*1024*1024 #most of any page we will read
+userAgents = [ #only used to retry after a 429
+  "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+  "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15",
+  "Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0",
+]
+
+async def main():
+  searches = sum(math.comb(len(basicKeywords), r) for r in range(1, len(basicKeywords)))
+  print("Searching", searches, "keyword combinations")
+  usedKeywords = {} #first spelling seen for each lowercased keyword
+  sem = asyncio.Semaphore(concurrency)
+  #keep connections and DNS answers warm so every search reuses the same TLS sessions to google
+  connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=perHost, keepalive_timeout=keepAlive, ttl_dns_cache=300)
+  #spawn, not fork: the event loop's resolver threads are running by the time workers start
+  spawn = multiprocessing.get_context("spawn")
+  with open(logFile, "wb", buffering=0) as log, ProcessPoolExecutor(mp_context=spawn, initializer=ignoreInterrupt) as pool:
+    #the session keeps aiohttp's own user agent, google answers it with the basic page of /url?q= links
+    async with aiohttp.ClientSession(connector=connector) as session:
+      searchKeywords = keywordCombinations(basicKeywords, querryChar) #keywords to search
+      uniqueURLs = {} #related queries rank the same sites, fetch each one only once
+      tasks = []
+      try:
+        tasks = [asyncio.create_task(searchQuery(session, sem, pool, keywords)) for keywords in searchKeywords]
+        for search in asyncio.as_completed(tasks):
+          keywords, links = await search
+          writeLog(log, {"query": keywords, "links": links})
+          uniqueURLs.update(dict.fromkeys(links))
+        tasks = [asyncio.create_task(scrapeKeywords(session, sem, pool, link)) for link in uniqueURLs]
+        for scrape in asyncio.as_completed(tasks):
+          link, metaKeywords = await scrape
+          newKeywords = []
+          for content in metaKeywords:
+            for keyword in (content or "").split(","):
+              keyword = keyword.strip()
+              folded = keyword.lower()
+              if keyword and folded not in usedKeywords:
+                usedKeywords[folded] = keyword
+                newKeywords.append(keyword)
+          writeLog(log, {"link": link, "keywords": newKeywords})
+      finally:
+        #on ctrl-c or an error, stop what's still running before the session closes under it
+        for task in tasks:
+          task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+#consolidate the log into the json export, also after an interrupted run
+def exportResults():
+  linksByQuery = {} #sites ranked for each query, in the order searches finished
+  usedKeywords = [] #output of keywords
+  loads = orjson.loads if orjson is not None else json.loads
+  with open(logFile, "rb") as log:
+    for line in log:
+      try:
+        record = loads(line)
+      except ValueError:
+        continue #cut off mid-write
+      if "query" in record:
+        linksByQuery[record["query"]] = record["links"]
+      else:
+        usedKeywords.extend(record["keywords"])
+
+  #URL to export, keyed by query in the order the queries are generated
+  allURLs = {}
+  for keywords in keywordCombinations(basicKeywords, querryChar):
+    if keywords in linksByQuery:
+      allURLs[keywords] = linksByQuery[keywords]
+
+  #stuff we required that's websites that ranked on first page and thier URLs
+  LinkKey ={ 
+      "links": allURLs, 
+      "keywords": usedKeywords 
+  } 
+      
+  # the json file where the output must be stored 
+  with open(exportFile, "wb") as export_file:
+    if orjson is not None:
+      export_file.write(orjson.dumps(LinkKey, option=orjson.OPT_INDENT_2))
+    else:
+      export_file.write(json.dumps(LinkKey, indent = 2, ensure_ascii = False).encode())
 
-#stuff we required that's websites that ranked on first page and thier URLs
-LinkKey ={ 
-    "links": allURLs, 
-    "keywords": usedKeywords 
-} 
-    
-# the json file where the output must be stored 
-export_file = open("LinksKeys-liteBiws.json", "w") 
-json.dump(LinkKey, export_file, indent = 3)
-export_file.close() 
+if __name__ == "__main__":
+  try:
+    asyncio.run(main())
+  except KeyboardInterrupt:
+    print("Interrupted, exporting what was scraped")
+  finally:
+    if os.path.exists(logFile): #missing if interrupted before the first search
+      exportResults()